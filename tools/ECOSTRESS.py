@@ -3,16 +3,16 @@ Interact with the NASA AppEEARS API to obtain and process ECOSTRESS satellite da
 
 Functions
 ----------
-get_token(username): 
+get_token(username, refresh=False): 
     Get authentication token from NASA Earthdata Login API.
 
-submit_task(token, request_name, start_date, end_date, aoi): 
+submit_task(token, request_name, start_date, end_date, aoi, layers=None): 
     Submit a task to the NASA AppEEARS API.
 
-list_tasks(token): 
+list_tasks(token, refresh=False): 
     List all the tasks associated with a user account.
 
-download_data_bundles(token, list_task_id): 
+download_data_bundles(token, list_task_id, max_workers=DOWNLOAD_WORKERS): 
     Download data bundles for the given task IDs.
 
 apply_cloud_masking(list_folder_name): 
@@ -21,36 +21,100 @@ apply_cloud_masking(list_folder_name):
 create_summer_median_composite(list_folder_name): 
     Create a seasonal median composite for the masked images in the specified folders.
 
-format_median_composite_cog(folder_name):
+format_median_composite_cog(folder_name, stack=False):
     Convert the median composite images in the specified folder to Cloud-Optimized GeoTIFF (COG) format.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from getpass import getpass
-from os.path import join, basename, splitext
+from os.path import join, basename
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import pandas as pd
 from glob import glob
 import rioxarray
-import rioxarray.merge
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
 import numpy as np
 import warnings
+import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from osgeo import gdal
 warnings.filterwarnings("ignore")
 
-def get_token(username):
+# GDAL settings for multi-gigabyte ECOSTRESS workloads, set before any file is opened:
+# a 2 GB block cache, multi-threaded compression and warping, no free disk space check on
+# file creation, and no directory listing when opening a file
+gdal.SetConfigOption("GDAL_CACHEMAX", "2048")
+gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
+gdal.SetConfigOption("CHECK_DISK_FREE_SPACE", "NO")
+gdal.SetConfigOption("VSI_CACHE", "TRUE")
+gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+
+# numba is optional: when it is installed the masking and the median composites use compiled kernels
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Number of bundle files downloaded concurrently from the AppEEARS API
+DOWNLOAD_WORKERS = 16
+
+# Physically plausible range of Land Surface Temperature in °C, values outside it are removed as outliers
+LST_VALID_RANGE = (-50.0, 80.0)
+
+# Number of images sent at once to each cloud masking worker process
+MASK_CHUNKSIZE = 4
+
+# Masked images with this fraction of missing pixels or more are left out of the median composites
+MAX_MISSING_FRACTION = 0.7
+
+# Size in pixels of the square blocks in which the median composites are computed and written
+COMPOSITE_BLOCK_SIZE = 512
+
+# Product-layer pairs requested by default by `submit_task`: LST and its cloud mask
+DEFAULT_LAYERS = [("ECO2LSTE.001", "SDS_LST"), ("ECO2CLD.001", "SDS_CloudMask")]
+
+# LST images whose cloud mask flags more than this fraction of pixels as cloudy are not downloaded
+MAX_CLOUD_FRACTION = 0.95
+
+# File where the AppEEARS token is persisted between sessions
+TOKEN_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "appeears", "token.json")
+
+# Margin before its expiration after which a persisted token is no longer reused
+TOKEN_EXPIRATION_MARGIN = timedelta(hours=1)
+
+# Folder where the task and bundle metadata of completed tasks are cached
+METADATA_CACHE_DIRECTORY = ".appeears_cache"
+
+# Task listings memoized by `list_tasks` per token
+_TASKS_CACHE = {}
+
+# HTTP sessions shared by all the calls to the AppEEARS API and the size of their connection pool, per token
+_SESSIONS = {}
+
+def get_token(username, refresh=False):
     """Get authentication token from NASA Earthdata Login API.
 
     This function sends a POST request to the NASA Earthdata Login API to
     obtain an authentication token for the specified username. This token
-    will expire approximately 48 hours after being acquired.
+    will expire approximately 48 hours after being acquired. The token is
+    persisted to `TOKEN_CACHE_FILE` and reused, without prompting for the
+    password, until one hour before its expiration. `get_token.invalidate()`
+    removes the persisted token.
 
     Parameters
     ----------
     username : str
         The username for authentication.
+    refresh : bool, optional
+        If True, ignore the persisted token and log in again. Default is False.
 
     Returns
     -------
@@ -71,6 +135,12 @@ def get_token(username):
     API Documentation: https://appeears.earthdatacloud.nasa.gov/api/?python#authentication
     """
 
+    # Reuse the token of a previous login while it is still valid
+    if not refresh:
+        token = _load_cached_token(username)
+        if token is not None:
+            return token
+
     # Define the URL for the NASA Earthdata Login API
     url = "https://appeears.earthdatacloud.nasa.gov/api/login"
     
@@ -79,11 +149,13 @@ def get_token(username):
     
     try:
         # Send a POST request with the provided username and password
-        response = requests.post(url, auth=(username, password))
+        response = _get_session().post(url, auth=(username, password))
         # Raise an exception if the request was not successful (status code >= 400)
         response.raise_for_status()
         # Extract the authentication token from the response JSON
         token = response.json()["token"]
+        # Persist the token together with its expiration date
+        _save_cached_token(username, response.json())
         # Return the authentication token
         return token
     
@@ -91,14 +163,89 @@ def get_token(username):
         # Print the error message if there was an exception
         print("Error:", e)
         return None
+
+
+def _get_session(token=None, pool_size=DOWNLOAD_WORKERS):
+    """Get the HTTP session shared by all the calls to the AppEEARS API made with the given token.
+
+    Reusing one session per token keeps the connections to the API open between
+    calls, so that TLS handshakes are not repeated. Requests failing with a
+    connection error, a 5xx status or a 429 (rate limited) status are retried up
+    to 5 times with exponential backoff, waiting as long as the Retry-After
+    header asks when the API sends one. Non-idempotent requests (POST) are not
+    retried after the request has been sent.
+
+    Parameters
+    ----------
+    token : str, optional
+        The authentication token sent in the Authorization header of every
+        request. None for the session used to log in.
+    pool_size : int, optional
+        The minimum number of connections kept open, which should match the
+        number of threads using the session concurrently. If the shared session
+        has a smaller pool, it is enlarged. Default is `DOWNLOAD_WORKERS`.
+
+    Returns
+    -------
+    requests.Session
+        The shared session.
+    """
+    if token not in _SESSIONS:
+        session = requests.Session()
+        if token is not None:
+            session.headers.update({'Authorization': 'Bearer {0}'.format(token)})
+        _SESSIONS[token] = (session, 0)
+
+    session, session_pool_size = _SESSIONS[token]
+    if session_pool_size < pool_size:
+        retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        session.mount('https://', HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size))
+        _SESSIONS[token] = (session, pool_size)
+    return session
+
+
+def _load_cached_token(username):
+    """Return the persisted token of the given user if it has not expired yet, otherwise None."""
+    try:
+        with open(TOKEN_CACHE_FILE) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("username") != username:
+        return None
+
+    # AppEEARS reports the expiration as an ISO 8601 UTC timestamp, e.g. '2023-06-03T10:15:00Z'
+    expiration = datetime.fromisoformat(cached["expiration"].replace("Z", "+00:00"))
+    if datetime.now(timezone.utc) >= expiration - TOKEN_EXPIRATION_MARGIN:
+        return None
+    return cached["token"]
+
+
+def _save_cached_token(username, login_json):
+    """Persist the token returned by the login endpoint to `TOKEN_CACHE_FILE`."""
+    os.makedirs(os.path.dirname(TOKEN_CACHE_FILE), exist_ok=True)
+    with open(TOKEN_CACHE_FILE, "w") as f:
+        json.dump({"username": username, "token": login_json["token"], "expiration": login_json["expiration"]}, f)
+    # The token grants access to the user account, keep it private
+    os.chmod(TOKEN_CACHE_FILE, 0o600)
+
+
+def _invalidate_cached_token():
+    """Remove the persisted token so that the next `get_token` call logs in again."""
+    if os.path.exists(TOKEN_CACHE_FILE):
+        os.remove(TOKEN_CACHE_FILE)
+
+
+get_token.invalidate = _invalidate_cached_token
     
 
-def submit_task(token,request_name, start_date, end_date, aoi):
+def submit_task(token,request_name, start_date, end_date, aoi, layers=None):
     """Submit a task to the NASA AppEEARS API.
 
     Submits a task to the NASA AppEEARS API to request ECOSTRESS satellite
     data for a specific area of interest (AOI) and time range. 
-    Two products-layers are requested:
+    By default, two products-layers are requested:
     - Product: ECO2LSTE.001 (ECOSTRESS Land Surface Temperature and 
       Emissivity Daily L2 Global 70 m)
       Layer: SDS_LST (Land Surface Temperature)
@@ -121,6 +268,9 @@ def submit_task(token,request_name, start_date, end_date, aoi):
     aoi : str
         A GeoJSON path defining the spatial region of interest.
         The projection of any coordinates must be in a geographic projection.
+    layers : list of tuple of str, optional
+        The (product, layer) pairs to request, e.g. [("ECO2CLD.001", "SDS_CloudMask")]
+        to submit the cloud mask as a task of its own. Default is `DEFAULT_LAYERS`.
 
     Returns
     -------
@@ -144,7 +294,8 @@ def submit_task(token,request_name, start_date, end_date, aoi):
     """
     
     # Extract Coordinates from AOI geojson
-    map_json = json.load(open(aoi))
+    with open(aoi) as f:
+        map_json = json.load(f)
     coords = map_json["features"][0]["geometry"]["coordinates"][0]
 
     # Create the task request JSON based on the input parameters
@@ -168,12 +319,9 @@ def submit_task(token,request_name, start_date, end_date, aoi):
                 "startDate": start_date
             }],
             "layers": [{
-                "layer": "SDS_LST",
-                "product": "ECO2LSTE.001"
-            }, {
-                "layer": "SDS_CloudMask",
-                "product": "ECO2CLD.001"
-            }],
+                "layer": layer,
+                "product": product
+            } for product, layer in (layers or DEFAULT_LAYERS)],
             "output": {
                 "format": {
                     "type": "geotiff"
@@ -187,11 +335,12 @@ def submit_task(token,request_name, start_date, end_date, aoi):
 
     try:
         # Make the request to submit the task
-        response = requests.post(
+        response = _get_session(token).post(
             'https://appeears.earthdatacloud.nasa.gov/api/task',
-            json=task,
-            headers={'Authorization': 'Bearer {0}'.format(token)}
+            json=task
         )
+        # The memoized task listing of this account no longer includes every task
+        _TASKS_CACHE.pop(token, None)
         response_json = response.json()
         return response_json
     
@@ -201,17 +350,22 @@ def submit_task(token,request_name, start_date, end_date, aoi):
         return None
     
 
-def list_tasks(token):
+def list_tasks(token, refresh=False):
     """List all the tasks associated with a user account.
 
     This function sends a GET request to the NASA AppEEARS API to retrieve
     information about all the tasks associated with the user account.
     It extracts the task names, IDs, and statuses from the JSON response.
+    Once every task of the account is done, the listing is memoized for the
+    rest of the session; while any task is still pending, each call queries
+    the API again so that its status can be followed.
 
     Parameters
     ----------
     token : str
         The authentication token obtained from the `get_token` function.
+    refresh : bool, optional
+        If True, ignore the memoized listing and query the API. Default is False.
 
     Returns
     -------
@@ -232,12 +386,12 @@ def list_tasks(token):
     API Documentation: https://appeears.earthdatacloud.nasa.gov/api/?python#list-tasks
     """
 
+    if not refresh and token in _TASKS_CACHE:
+        return [dict(task) for task in _TASKS_CACHE[token]]
+
     try:
         # Send a GET request to retrieve the tasks associated with the user account
-        response = requests.get(
-            'https://appeears.earthdatacloud.nasa.gov/api/task',
-            headers={'Authorization': 'Bearer {0}'.format(token)}
-        )
+        response = _get_session(token).get('https://appeears.earthdatacloud.nasa.gov/api/task')
         # Parse the JSON response
         response_json = response.json()
         # Extract the Task names, IDs, and statuses from the JSON object
@@ -245,6 +399,9 @@ def list_tasks(token):
             {"name": task["task_name"], "id": task["task_id"], "status": task["status"]}
             for task in response_json
         ]
+        # The listing only changes when a task progresses or a new task is submitted
+        if all(task["status"] == "done" for task in tasks_list):
+            _TASKS_CACHE[token] = [dict(task) for task in tasks_list]
         return tasks_list
     
     except requests.exceptions.RequestException as e:
@@ -253,7 +410,7 @@ def list_tasks(token):
         return []
     
 
-def download_data_bundles(token, list_task_id):
+def download_data_bundles(token, list_task_id, max_workers=DOWNLOAD_WORKERS):
     """Download data bundles for the given task IDs.
 
     This function  downloads the data bundles linked to the given task IDs
@@ -261,7 +418,10 @@ def download_data_bundles(token, list_task_id):
     comprises various files, primarily the raw Land Surface Temperature (LST) 
     ECOSTRESS images and their corresponding cloud mask files. The function 
     generates a destination folder for each task based on its name with the '_Raw' 
-    ending and stores the downloaded files within the respective folder.
+    ending and stores the downloaded files within the respective folder. The files
+    of all the bundles are downloaded concurrently over a shared HTTP session. The cloud
+    masks are downloaded first, and LST images whose cloud mask flags more than
+    `MAX_CLOUD_FRACTION` of the pixels as cloudy are not downloaded.
 
     Parameters
     ----------
@@ -270,6 +430,9 @@ def download_data_bundles(token, list_task_id):
     list_task_id : list of str
          A list of task IDs (as strings) for which data bundles should be 
          downloaded.
+    max_workers : int, optional
+        The maximum number of files downloaded at the same time. Default is
+        `DOWNLOAD_WORKERS`.
     
     Returns
     -------
@@ -285,48 +448,203 @@ def download_data_bundles(token, list_task_id):
     API Documentation: https://appeears.earthdatacloud.nasa.gov/api/?python#download-file
     """
 
-    for task_id in list_task_id:
-        # Get the task name
-        task = requests.get(
-            'https://appeears.earthdatacloud.nasa.gov/api/task/{0}'.format(task_id),
-            headers={'Authorization': 'Bearer {0}'.format(token)}
+    # Share a single connection pool, with a connection per worker, across all tasks so TLS handshakes are reused
+    session = _get_session(token, pool_size=max_workers)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Get the task name and the data bundle of all the requested task IDs concurrently
+        metadata = list(executor.map(lambda task_id: _get_task_metadata(session, task_id), list_task_id))
+
+        # Download state of each task, and the task ID and file of each pending download
+        tasks = {}
+        pending = {}
+        for task_id, (task_json, bundle_json) in zip(list_task_id, metadata):
+            # Create a destination folder based on task name
+            dest_dir = task_json['task_name'] + "_Raw"
+            os.makedirs(dest_dir, exist_ok=True)
+
+            # LST images are only downloaded once the cloud mask of the same acquisition shows it is not fully cloudy
+            cloud_stamps = {_acquisition_stamp(file_json['file_name']) for file_json in bundle_json['files']
+                            if '_CloudMask_' in file_json['file_name']}
+            deferred_LST = {
+                _acquisition_stamp(file_json['file_name']): file_json for file_json in bundle_json['files']
+                if '_LST_' in file_json['file_name'] and _acquisition_stamp(file_json['file_name']) in cloud_stamps
+            }
+            deferred_ids = {file_json['file_id'] for file_json in deferred_LST.values()}
+            tasks[task_id] = {'task_name': task_json['task_name'], 'dest_dir': dest_dir,
+                              'deferred_LST': deferred_LST, 'remaining': 0, 'skipped': 0}
+
+            # Download all the other files of every bundle concurrently
+            for file_json in bundle_json['files']:
+                if file_json['file_id'] not in deferred_ids:
+                    pending[_submit_download(executor, session, task_id, dest_dir, file_json)] = (task_id, file_json)
+                    tasks[task_id]['remaining'] += 1
+            if tasks[task_id]['remaining'] == 0:
+                _print_task_downloaded(task_id, tasks[task_id])
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task_id, file_json = pending.pop(future)
+                task = tasks[task_id]
+                task['remaining'] -= 1
+                # Re-raise any error that occurred while downloading the file
+                dest_path = future.result()
+
+                stamp = _acquisition_stamp(file_json['file_name'])
+                if '_CloudMask_' in file_json['file_name'] and stamp in task['deferred_LST']:
+                    LST_json = task['deferred_LST'].pop(stamp)
+                    if _cloud_fraction(dest_path) > MAX_CLOUD_FRACTION:
+                        task['skipped'] += 1
+                    else:
+                        pending[_submit_download(executor, session, task_id, task['dest_dir'], LST_json)] = (task_id, LST_json)
+                        task['remaining'] += 1
+
+                if task['remaining'] == 0:
+                    _print_task_downloaded(task_id, task)
+
+
+def _print_task_downloaded(task_id, task):
+    """Report that all the files of a task have been downloaded."""
+    if task['skipped'] > 0:
+        print('{0} LST images with more than {1:.0%} cloud cover were not downloaded.'.format(task['skipped'], MAX_CLOUD_FRACTION))
+
+    print(
+        'Download for Task ID {0} corresponding to Task Name {1} has been completed.'.format(
+            task_id, task['task_name']
         )
-        task_json = task.json()
-        task_name = task_json['task_name']
+    )
 
-        # Create a destination folder based on task name
-        dest_dir = task_name + "_Raw"
-        os.makedirs(dest_dir, exist_ok=True)
 
-        # Get the data bundle of the requested task ID
-        bundle = requests.get(
-            'https://appeears.earthdatacloud.nasa.gov/api/bundle/{0}'.format(task_id),
-            headers={'Authorization': 'Bearer {0}'.format(token)}
-        )
-        bundle_json = bundle.json()
-
-        # Download all the files in the bundle
-        for i in range(len(bundle_json['files'])):
-            file = requests.get(
-                'https://appeears.earthdatacloud.nasa.gov/api/bundle/{0}/{1}'.format(
-                    task_id, bundle_json['files'][i]['file_id']
-                ),
-                headers={'Authorization': 'Bearer {0}'.format(token)},
-                allow_redirects=True,
-                stream=True
-            )
+def _submit_download(executor, session, task_id, dest_dir, file_json):
+    """Submit the download of a bundle file to the executor and return its future.
+
+    The result of the future is the local path of the file.
+    """
+    dest_path = os.path.join(dest_dir, os.path.split(file_json['file_name'])[-1])
+    url = 'https://appeears.earthdatacloud.nasa.gov/api/bundle/{0}/{1}'.format(task_id, file_json['file_id'])
+    return executor.submit(_download_file, session, url, dest_path, file_json.get('file_size'))
 
-            with open(
-                os.path.join(dest_dir, os.path.split(bundle_json['files'][i]['file_name'])[-1]), 'wb'
-            ) as f:
-                for data in file.iter_content(chunk_size=8192):
-                    f.write(data)
 
-        print(
-            'Download for Task ID {0} corresponding to Task Name {1} has been completed.'.format(
-                task_id, task_name
-            )
-        )
+def _acquisition_stamp(filename):
+    """Get the 'doyYYYYJJJHHMMSS' acquisition stamp of an AppEEARS file name, or None if it has none."""
+    parts = os.path.basename(filename).rsplit('_', 2)
+    return parts[-2] if len(parts) == 3 and parts[-2].startswith('doy') else None
+
+
+def _cloud_fraction(cloud_filename):
+    """Get the fraction of pixels flagged as cloudy (bit 2) in a cloud mask file."""
+    with rasterio.open(cloud_filename) as src:
+        cloud = src.read(1)
+    return np.mean((cloud >> 2) & 1)
+
+
+def _get_task_metadata(session, task_id):
+    """Get the task and bundle metadata of a task from the AppEEARS API.
+
+    The bundle listing of a completed task never changes, so the metadata of tasks
+    with status 'done' is cached as JSON in `METADATA_CACHE_DIRECTORY` and read
+    from there on later calls instead of querying the API again.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session holding the authorization header and the connection pool.
+    task_id : str
+        The ID of the task.
+
+    Returns
+    -------
+    tuple of dict
+        The task JSON and the bundle JSON.
+    """
+    cache_path = os.path.join(METADATA_CACHE_DIRECTORY, '{0}.json'.format(task_id))
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        return cached['task'], cached['bundle']
+
+    task_json = session.get('https://appeears.earthdatacloud.nasa.gov/api/task/{0}'.format(task_id)).json()
+    bundle_json = session.get('https://appeears.earthdatacloud.nasa.gov/api/bundle/{0}'.format(task_id)).json()
+
+    if task_json.get('status') == 'done':
+        os.makedirs(METADATA_CACHE_DIRECTORY, exist_ok=True)
+        with open(cache_path, 'w') as f:
+            json.dump({'task': task_json, 'bundle': bundle_json}, f)
+
+    return task_json, bundle_json
+
+
+def _download_file(session, url, dest_path, size=None):
+    """Stream a single bundle file from the AppEEARS API to disk.
+
+    Files already on disk with the expected size are skipped. The download is
+    written to `dest_path + '.part'` and renamed once complete, so an interrupted
+    download is resumed from its last byte with an HTTP Range request instead of
+    starting from zero. The response body is copied to disk in 1 MiB blocks by
+    `shutil.copyfileobj`, which keeps the copy loop out of the Python interpreter.
+
+    Parameters
+    ----------
+    session : requests.Session
+        The session holding the authorization header and the connection pool.
+    url : str
+        The URL of the bundle file.
+    dest_path : str
+        The local path where the file is written.
+    size : int, optional
+        The size of the file in bytes, as listed in the bundle. If None, it is
+        requested from the server with a HEAD request.
+
+    Returns
+    -------
+    str
+        The local path of the file.
+
+    Raises
+    ------
+    RuntimeError
+        If fewer bytes than the size of the file were received. The partial
+        file is kept, and the download is resumed by the next call.
+    """
+    if size is None:
+        head = session.head(url, allow_redirects=True)
+        # The Content-Length of an error response (e.g. a storage URL refusing HEAD) is the size of the error body
+        size = int(head.headers['Content-Length']) if head.ok and 'Content-Length' in head.headers else None
+
+    # Skip files that have already been downloaded
+    if size is not None and os.path.exists(dest_path) and os.path.getsize(dest_path) == size:
+        return dest_path
+
+    part_path = dest_path + '.part'
+    downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if size is not None and downloaded > size:
+        # The partial file does not belong to this download, start over
+        downloaded = 0
+
+    if size is None or downloaded < size:
+        # Ask for the raw file bytes, so that sizes and ranges refer to the file on disk
+        headers = {'Accept-Encoding': 'identity'}
+        if downloaded > 0:
+            headers['Range'] = 'bytes={0}-'.format(downloaded)
+        with session.get(url, allow_redirects=True, stream=True, headers=headers) as response:
+            # 416 Range Not Satisfiable means the partial file already holds the whole file
+            if response.status_code != 416:
+                response.raise_for_status()
+                # 206 Partial Content means the server honoured the range, otherwise the whole file is sent
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                # Only let urllib3 decode the body if the server compressed it anyway
+                response.raw.decode_content = 'Content-Encoding' in response.headers
+                with open(part_path, mode) as f:
+                    shutil.copyfileobj(response.raw, f, length=1 << 20)
+
+    # A connection closed early is not detected by urllib3 1.26, keep the partial file so the next run resumes it
+    if size is not None and os.path.getsize(part_path) != size:
+        raise RuntimeError('Download of {0} is incomplete: {1} of {2} bytes received.'.format(
+            dest_path, os.path.getsize(part_path), size))
+
+    os.replace(part_path, dest_path)
+    return dest_path
 
 
 def apply_cloud_masking(list_folder_name):
@@ -337,6 +655,8 @@ def apply_cloud_masking(list_folder_name):
     that contains both the raw images and the associated cloud mask files. The function
     creates an output directory to store the processed images as masked TIFF files. The output
     directory is named by replacing '_Raw' in the input folder name with '_Masked'.
+    The images of a folder are masked in parallel, one process per CPU core. The
+    fraction of missing pixels of each masked image is recorded in a '.json' sidecar file.
 
     Parameters
     ----------
@@ -365,46 +685,210 @@ def apply_cloud_masking(list_folder_name):
         os.makedirs(output_directory, exist_ok=True)
 
         # Create Data Frame: date, raw data file path, cloud mask file path and  masked tiff file path
-        LST_filenames=[]
-        LST_raw_filenames = pd.DataFrame({"LST_raw_filename": sorted(glob(join(folder_name, "*_LST_*.tif")))})
-        LST_raw_filenames["datetime_UTC"] = LST_raw_filenames.LST_raw_filename.apply(lambda LST_raw_filename: datetime.strptime(splitext(basename(LST_raw_filename))[0].split("_")[-2][3:], "%Y%j%H%M%S"))
-
-        cloud_filenames = pd.DataFrame({"cloud_filename": sorted(glob(join(folder_name, "*_CloudMask_*.tif")))})
-        cloud_filenames["datetime_UTC"] = cloud_filenames.cloud_filename.apply(lambda cloud_filename: datetime.strptime(splitext(basename(cloud_filename))[0].split("_")[-2][3:], "%Y%j%H%M%S"))
-
-        LST_filenames = pd.merge(LST_raw_filenames, cloud_filenames)
-        LST_filenames["LST_masked_filename"] = LST_filenames.datetime_UTC.apply(lambda datetime_UTC: join(output_directory, f"{datetime_UTC:%Y.%m.%d.%H.%M.%S}_LST.tif"))
-        LST_filenames = LST_filenames[["datetime_UTC", "LST_raw_filename", "cloud_filename", "LST_masked_filename"]]
+        LST_filenames = _load_filenames_index(folder_name, output_directory)
         print(LST_filenames["LST_raw_filename"][0])
 
-        # Cloud Mask Application
-        for i, (datetime_UTC, LST_raw_filename, cloud_filename, LST_masked_filename) in LST_filenames.iterrows():
-            # Open LST raw image file
-            LST = rioxarray.open_rasterio(LST_raw_filename).squeeze("band", drop=True)
-            # Convert values of raw image file to Temperature → Apply Scale factor to DN and then convert from K to °C
-            LST.data = np.where(LST.data == 0, np.nan, LST.data * 0.02) - 273.15
-            # Open associated cloud file and make sure it is on the same spatial grid as the LST raw image file
-            cloud = rioxarray.open_rasterio(cloud_filename).squeeze("band", drop=True).rio.reproject_match(LST)
-            # Bit masking to convert to a cloud mask
-            cloud.data = (cloud.data >> 2) & 1
-            # Apply cloud mask
-            LST.data = np.where(cloud.data, np.nan, LST.data)
-
-            # Remove possible outliers
-            low, high = np.nanquantile(LST.data, [0.01, 0.99])
-            LST.data = np.where((LST.data < low) | (LST.data > high), np.nan, LST.data)
-
-            # Quantify missing pixels in the image
-            #missing_proportion = np.count_nonzero(np.isnan(LST.data)) / LST.data.size
-            #if missing_proportion > 0.5:
-            #   continue
-
-            # Write image as a new .tif
-            LST.rio.to_raster(LST_masked_filename)
-        
+        # Cloud Mask Application: the images are independent, so they are masked in parallel processes
+        max_workers = max(1, min(os.cpu_count() or 1, len(LST_filenames)))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_mask_worker) as executor:
+            # The images are sent to the workers in chunks to reduce the inter-process communication
+            masked_filenames = executor.map(_mask_one, LST_filenames.LST_raw_filename, LST_filenames.cloud_filename,
+                                            LST_filenames.LST_masked_filename, chunksize=MASK_CHUNKSIZE)
+            # Re-raise any error that occurred while masking the images
+            for completed, _ in enumerate(masked_filenames, start=1):
+                print('{0}/{1} images masked.'.format(completed, len(LST_filenames)))
+
         print('Masking for folder {0} has been completed.'.format(folder_name))
 
 
+def _load_filenames_index(folder_name, output_directory):
+    """Build the Data Frame pairing the raw LST images of a folder with their cloud mask files.
+
+    The Data Frame is cached in the output directory together with the modification
+    time of the input folder, and reused as long as the folder content is unchanged.
+
+    Parameters
+    ----------
+    folder_name : str
+        The folder containing the raw LST images and cloud mask files.
+    output_directory : str
+        The folder where the masked images are written.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The date, raw data file path, cloud mask file path and masked tiff file path of each image.
+    """
+    index_path = join(output_directory, ".index.pkl")
+    folder_mtime = os.stat(folder_name).st_mtime_ns
+    if os.path.exists(index_path):
+        index = pd.read_pickle(index_path)
+        if index["folder_mtime"] == folder_mtime:
+            return index["LST_filenames"]
+
+    LST_raw_filenames = _parse_acquisition_datetimes(sorted(glob(join(folder_name, "*_LST_*.tif"))), "LST_raw_filename")
+    cloud_filenames = _parse_acquisition_datetimes(sorted(glob(join(folder_name, "*_CloudMask_*.tif"))), "cloud_filename")
+
+    LST_filenames = pd.merge(LST_raw_filenames, cloud_filenames, on="datetime_UTC")
+    LST_filenames["LST_masked_filename"] = join(output_directory, "") + LST_filenames.datetime_UTC.dt.strftime("%Y.%m.%d.%H.%M.%S") + "_LST.tif"
+    LST_filenames = LST_filenames[["datetime_UTC", "LST_raw_filename", "cloud_filename", "LST_masked_filename"]]
+
+    pd.to_pickle({"folder_mtime": folder_mtime, "LST_filenames": LST_filenames}, index_path)
+    return LST_filenames
+
+
+def _parse_acquisition_datetimes(filenames, column):
+    """Create a Data Frame with the given AppEEARS file names and their acquisition date.
+
+    The date is the 'doyYYYYJJJHHMMSS' part of the file name, e.g.
+    'ECO2LSTE.001_SDS_LST_doy2022152120000_aid0001.tif', parsed in one vectorized call.
+    """
+    names = pd.Series(filenames, name=column, dtype=object)
+    stamps = names.map(basename).str.rsplit("_", n=2).str[-2].str[3:]
+    return pd.DataFrame({column: names, "datetime_UTC": pd.to_datetime(stamps, format="%Y%j%H%M%S")})
+
+
+def _init_mask_worker():
+    """Limit GDAL to one thread in each masking process to avoid oversubscribing the CPU."""
+    # A config option set with gdal.SetConfigOption takes precedence over the environment variable
+    gdal.SetConfigOption("GDAL_NUM_THREADS", "1")
+
+
+def _mask_one(LST_raw_filename, cloud_filename, LST_masked_filename):
+    """Apply cloud masking to a single raw LST image and write the masked image.
+
+    Parameters
+    ----------
+    LST_raw_filename : str
+        The path of the raw LST image.
+    cloud_filename : str
+        The path of the associated cloud mask file.
+    LST_masked_filename : str
+        The path where the masked LST image is written.
+
+    Returns
+    -------
+    str
+        The path of the masked LST image.
+    """
+    # Open LST raw image file and the associated cloud file on the same spatial grid
+    with rasterio.open(LST_raw_filename) as LST_src:
+        LST_data = LST_src.read(1, out_dtype="float32")
+        cloud = _read_cloud_on_grid(cloud_filename, LST_src)
+        profile = {
+            "driver": "COG",
+            "dtype": "float32",
+            "count": 1,
+            "nodata": np.nan,
+            "crs": LST_src.crs,
+            "transform": LST_src.transform,
+            "width": LST_src.width,
+            "height": LST_src.height,
+        }
+
+    # Convert the raw image to Temperature and remove no data, cloudy and outlier pixels
+    nan_frac = _mask_LST(LST_data, cloud)
+
+    # Record the proportion of missing pixels in a sidecar file, used to leave mostly empty images out of the composites
+    with open(LST_masked_filename + ".json", "w") as f:
+        json.dump({"nan_frac": nan_frac}, f)
+
+    # Write image as a new tiled and compressed float32 Cloud-Optimized GeoTIFF. The NUM_THREADS creation option
+    # is left unset so that the single GDAL thread of the masking worker processes applies
+    with rasterio.open(LST_masked_filename, "w", compress="ZSTD", level=3, predictor=3, blocksize=512,
+                       BIGTIFF="IF_SAFER", **profile) as dst:
+        dst.write(LST_data, 1)
+
+    return LST_masked_filename
+
+
+def _mask_LST(LST_data, cloud):
+    """Convert a raw LST image to °C in place and set its no data, cloudy and outlier pixels to NaN.
+
+    Uses a numba kernel making a single pass over the pixels when numba is installed,
+    and numpy operations otherwise.
+
+    Parameters
+    ----------
+    LST_data : numpy.ndarray
+        The float32 raw LST image, modified in place.
+    cloud : numpy.ndarray
+        The cloud mask on the same grid as the LST image.
+
+    Returns
+    -------
+    float
+        The fraction of pixels set to NaN.
+    """
+    if njit is not None:
+        n_bad = _mask_LST_kernel(LST_data.reshape(-1), np.ascontiguousarray(cloud).reshape(-1),
+                                 np.float32(LST_VALID_RANGE[0]), np.float32(LST_VALID_RANGE[1]))
+        return n_bad / LST_data.size
+
+    # Pixels without data (DN = 0) or flagged as cloudy (bit 2 of the cloud mask)
+    bad = (LST_data == 0) | ((cloud >> 2) & 1).astype(bool)
+
+    # Convert values of raw image file to Temperature → Apply Scale factor to DN and then convert from K to °C
+    np.multiply(LST_data, np.float32(0.02), out=LST_data)
+    np.subtract(LST_data, np.float32(273.15), out=LST_data)
+
+    # Remove physically implausible values
+    np.logical_or(bad, LST_data < LST_VALID_RANGE[0], out=bad)
+    np.logical_or(bad, LST_data > LST_VALID_RANGE[1], out=bad)
+
+    # Apply no data, cloud and outlier mask
+    LST_data[bad] = np.nan
+    return float(bad.mean(dtype=np.float64))
+
+
+if njit is not None:
+    # The images are already masked in parallel processes, so the kernel itself is serial.
+    # fastmath is left off on purpose: it assumes there are no NaNs
+    @njit(cache=True)
+    def _mask_LST_kernel(LST_data, cloud, low, high):
+        n_bad = 0
+        for i in range(LST_data.size):
+            # Pixels without data (DN = 0) or flagged as cloudy (bit 2 of the cloud mask)
+            raw = LST_data[i]
+            v = raw * np.float32(0.02) - np.float32(273.15)
+            if raw == 0 or (cloud[i] >> 2) & 1 or v < low or v > high:
+                LST_data[i] = np.nan
+                n_bad += 1
+            else:
+                LST_data[i] = v
+        return n_bad
+
+
+def _read_cloud_on_grid(cloud_filename, LST_src):
+    """Read a cloud mask file on the spatial grid of the given LST image.
+
+    The LST and cloud mask files of one ECOSTRESS granule usually share the same
+    grid, in which case the cloud mask is read as is. Otherwise the file is
+    read through a warped VRT so GDAL resamples it on the fly while reading,
+    instead of warping a full in-memory copy. Nearest neighbour resampling keeps
+    the categorical values of the cloud mask.
+
+    Parameters
+    ----------
+    cloud_filename : str
+        The path of the cloud mask file.
+    LST_src : rasterio.io.DatasetReader
+        The open LST image whose grid the cloud mask is matched to.
+
+    Returns
+    -------
+    numpy.ndarray
+        The cloud mask on the grid of the LST image.
+    """
+    with rasterio.open(cloud_filename) as src:
+        if src.shape == LST_src.shape and src.transform == LST_src.transform and src.crs == LST_src.crs:
+            return src.read(1)
+
+        with WarpedVRT(src, crs=LST_src.crs, transform=LST_src.transform, width=LST_src.width,
+                       height=LST_src.height, resampling=Resampling.nearest) as vrt:
+            return vrt.read(1)
+
+
 def create_summer_median_composite(list_folder_name): 
     """Create a seasonal median composite for the masked images in the specified folders.
 
@@ -412,6 +896,11 @@ def create_summer_median_composite(list_folder_name):
     images that have been masked. It then creates a median composite in TIFF format for each 
     folder, representing the median values of LST over a summer season.The function creates an
     output directory called 'Summer Median Composites' to store the composite images.
+    Images with `MAX_MISSING_FRACTION` or more missing pixels, as recorded by
+    `apply_cloud_masking`, are left out. The images are stacked in a VRT
+    (`LST_stack.vrt` in each folder) that is read lazily as a dask array, and the
+    composite is computed and written block by block, so only a few blocks of every
+    image are held in memory at a time.
 
     Parameters
     ----------
@@ -439,17 +928,140 @@ def create_summer_median_composite(list_folder_name):
     for folder_name in list_folder_name:
         # Create Median Seasonal Composite
         ST_masked_filenames=[]
-        ST_masked_filenames = sorted(glob(join(folder_name, "*_LST.tif")))
-        ST_masked_rasters = [rioxarray.open_rasterio(filename).squeeze("band", drop=True) for filename in ST_masked_filenames]
-        ST_composite = rioxarray.merge.merge_arrays(ST_masked_rasters, nodata=np.nan)
-        ST_composite.data = np.nanmedian(np.stack([raster.rio.reproject_match(ST_composite).data for raster in ST_masked_rasters]), axis=0)
-        ST_composite.data = np.where(ST_composite.data == 0, np.nan, ST_composite.data)
-        ST_composite.rio.to_raster(os.path.join(output_directory_median, f"Median_{folder_name}.tif"))
+        ST_masked_filenames = [
+            filename for filename in sorted(glob(join(folder_name, "*_LST.tif")))
+            if _missing_fraction(filename) < MAX_MISSING_FRACTION
+        ]
+        if not ST_masked_filenames:
+            print('No image in the folder {0} has less than {1:.0%} missing pixels, no composite was created.'.format(folder_name, MAX_MISSING_FRACTION))
+            continue
+
+        ST_stack_filename = join(folder_name, "LST_stack.vrt")
+        _build_time_stack(ST_masked_filenames, ST_stack_filename)
+
+        # Read the time stack lazily in dask chunks holding every image of a block, as the median needs them all at once
+        # The stack is closed once the composite is written, releasing the GDAL file handles
+        with rioxarray.open_rasterio(
+            ST_stack_filename, chunks={"band": -1, "x": COMPOSITE_BLOCK_SIZE, "y": COMPOSITE_BLOCK_SIZE}, lock=False
+        ) as ST_stack:
+            ST_composite = ST_stack.isel(band=0, drop=True).copy(
+                data=ST_stack.data.map_blocks(_median_block, drop_axis=0, dtype=np.float32)
+            )
+            ST_composite.rio.write_nodata(np.nan, inplace=True)
+
+            # Compute and write the composite block by block
+            ST_composite.rio.to_raster(os.path.join(output_directory_median, f"Median_{folder_name}.tif"), dtype="float32",
+                                       tiled=True, blockxsize=COMPOSITE_BLOCK_SIZE, blockysize=COMPOSITE_BLOCK_SIZE,
+                                       lock=threading.Lock())
 
         print('Summer Median Composite for images in the folder {0} has been completed.'.format(folder_name))
 
 
-def format_median_composite_cog(folder_name):
+def _missing_fraction(filename):
+    """Get the fraction of missing pixels of a masked image from its sidecar file, or 0 if it has none."""
+    try:
+        with open(filename + ".json") as f:
+            return json.load(f)["nan_frac"]
+    # A sidecar left truncated or empty by an interrupted masking worker is treated as missing
+    except (OSError, ValueError, KeyError):
+        return 0.0
+
+
+def _median_block(stack):
+    """Reduce a (N, H, W) block of masked images to its median composite, with 0 values as NaN."""
+    block = _nanmedian_axis0(stack)
+    block[block == 0] = np.nan
+    return block
+
+
+def _nanmedian_axis0(stack):
+    """Compute the median along the first axis of a 3D array, ignoring NaNs.
+
+    Uses a compiled numba kernel when numba is installed and falls back to
+    `np.nanmedian` otherwise.
+
+    Parameters
+    ----------
+    stack : numpy.ndarray
+        A (N, H, W) array.
+
+    Returns
+    -------
+    numpy.ndarray
+        A (H, W) float32 array; NaN where all N values are NaN.
+    """
+    if njit is None:
+        return np.nanmedian(stack, axis=0).astype(np.float32, copy=False)
+    out = np.empty(stack.shape[1:], dtype=np.float32)
+    _nanmedian_axis0_kernel(np.ascontiguousarray(stack, dtype=np.float32), out)
+    return out
+
+
+if njit is not None:
+    # The kernel is serial: dask already calls it from several threads at once, and numba's parallel
+    # threading layers either abort on concurrent calls (workqueue) or oversubscribe the CPU.
+    # fastmath is left off on purpose: it assumes there are no NaNs and would break the NaN test
+    @njit(cache=True)
+    def _nanmedian_axis0_kernel(stack, out):
+        N, H, W = stack.shape
+        for h in range(H):
+            # Scratch vector holding the valid values of one pixel
+            buf = np.empty(N, np.float32)
+            for w in range(W):
+                k = 0
+                for n in range(N):
+                    v = stack[n, h, w]
+                    if v == v:
+                        buf[k] = v
+                        k += 1
+                if k == 0:
+                    out[h, w] = np.nan
+                else:
+                    half = k // 2
+                    values = np.partition(buf[:k], half)
+                    if k % 2 == 1:
+                        out[h, w] = values[half]
+                    else:
+                        out[h, w] = (values[:half].max() + values[half]) / 2
+
+
+def _build_time_stack(filenames, vrt_filename):
+    """Stack images as the bands of a VRT on a grid covering all of them.
+
+    The VRT is a time stack of the images: reading a block of it reads the same
+    window of every image, without opening and reprojecting each file separately.
+    As in `rioxarray.merge.merge_arrays`, the grid covers the union of the extents
+    with the resolution of the first image. All images must share the same CRS,
+    which is the case for the AppEEARS outputs in native projection.
+
+    Parameters
+    ----------
+    filenames : list of str
+        The paths of the images.
+    vrt_filename : str
+        The path where the VRT is written.
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    RuntimeError
+        If some images could not be added to the VRT, e.g. because their CRS differs.
+    """
+    with rasterio.open(filenames[0]) as src:
+        x_res, y_res = src.res
+
+    vrt = gdal.BuildVRT(vrt_filename, filenames, separate=True, resolution="user", xRes=x_res, yRes=y_res,
+                        srcNodata="nan", VRTNodata="nan")
+    if vrt is None or vrt.RasterCount != len(filenames):
+        raise RuntimeError('Could not stack the images into {0}: {1}'.format(vrt_filename, gdal.GetLastErrorMsg()))
+    # Close the dataset to flush it to disk
+    vrt = None
+
+
+def format_median_composite_cog(folder_name, stack=False):
     """Convert the median composite images in the specified folder to Cloud-Optimized GeoTIFF (COG) format.
 
     This function converts the median composite images in the specified folder to Cloud-Optimized
@@ -457,10 +1069,17 @@ def format_median_composite_cog(folder_name):
     and retrieval. The converted COG files are saved in the same folder with "_cog.tif" 
     appended to the original filenames.
 
+    Optionally, composites sharing the same grid (CRS, transform and size) are stacked into a
+    single multi-band COG per grid, named 'Median_Stack_<n>_cog.tif', whose band descriptions
+    are the names of the original composites.
+
     Parameters
     ----------
     folder_name : str
         The name of the folder containing the median composite images.
+    stack : bool, optional
+        If True, stack the composites sharing the same grid into one multi-band COG.
+        Default is False.
 
     Returns
     -------
@@ -476,12 +1095,91 @@ def format_median_composite_cog(folder_name):
     GDAL Documentation: https://gdal.org/programs/gdal_translate.html
     Cloud-Optimized GeoTIFF: https://www.cogeo.org/
     """
-    for tif_file in os.listdir(folder_name):
-        if tif_file.endswith(".tif"):
-            # create output file path
-            out_file = os.path.join(folder_name, os.path.splitext(tif_file)[0] + "_cog.tif")
-            # run gdal_translate command with specified options
-            gdal.Translate(out_file, os.path.join(folder_name, tif_file),
-                        creationOptions=['TILED=YES', 'COPY_SRC_OVERVIEWS=YES', 'COMPRESS=DEFLATE'])
-            
-        print('Summer Median Composite: {0} was successfully format to COG.'.format(tif_file))
+    # Skip the outputs of previous runs
+    tif_files = sorted(tif_file for tif_file in os.listdir(folder_name) if tif_file.endswith(".tif") and not tif_file.endswith("_cog.tif"))
+
+    if stack:
+        # Group the composites by grid
+        groups = defaultdict(list)
+        for tif_file in tif_files:
+            with rasterio.open(os.path.join(folder_name, tif_file)) as src:
+                groups[(src.crs, tuple(src.transform), src.width, src.height)].append(tif_file)
+        groups = list(groups.values())
+    else:
+        groups = [[tif_file] for tif_file in tif_files]
+
+    # GDAL releases the GIL while translating, so the files are converted in parallel threads
+    with ThreadPoolExecutor() as executor:
+        futures = {}
+        for n, group in enumerate(groups, start=1):
+            if len(group) == 1:
+                out_file = os.path.join(folder_name, os.path.splitext(group[0])[0] + "_cog.tif")
+                future = executor.submit(_translate_to_cog, os.path.join(folder_name, group[0]), out_file)
+            else:
+                out_file = os.path.join(folder_name, "Median_Stack_{0}_cog.tif".format(n))
+                future = executor.submit(_stack_to_cog, [os.path.join(folder_name, tif_file) for tif_file in group], out_file)
+            futures[future] = group
+
+        for future in as_completed(futures):
+            # Re-raise any error that occurred while converting the file
+            future.result()
+            print('Summer Median Composite: {0} was successfully format to COG.'.format(', '.join(futures[future])))
+
+
+def _stack_to_cog(src_files, out_file):
+    """Stack GeoTIFFs sharing the same grid into a single multi-band Cloud-Optimized GeoTIFF.
+
+    The files are stacked as the bands of an in-memory VRT, described by the name of
+    their source file, and the VRT is converted with `_translate_to_cog`.
+
+    Parameters
+    ----------
+    src_files : list of str
+        The paths of the source GeoTIFFs.
+    out_file : str
+        The path of the output COG.
+
+    Returns
+    -------
+    None
+    """
+    vrt_file = "/vsimem/{0}.vrt".format(os.path.basename(out_file))
+    vrt = gdal.BuildVRT(vrt_file, src_files, separate=True)
+    for i, src_file in enumerate(src_files, start=1):
+        vrt.GetRasterBand(i).SetDescription(os.path.splitext(os.path.basename(src_file))[0])
+    try:
+        _translate_to_cog(vrt, out_file)
+    finally:
+        vrt = None
+        gdal.Unlink(vrt_file)
+
+
+def _translate_to_cog(src_file, out_file):
+    """Convert a GeoTIFF to a Cloud-Optimized GeoTIFF with the GDAL COG driver.
+
+    The COG driver builds the overviews and writes them before the full resolution
+    image, as the COG layout requires.
+
+    Parameters
+    ----------
+    src_file : str or osgeo.gdal.Dataset
+        The path of the source GeoTIFF, or an open dataset.
+    out_file : str
+        The path of the output COG.
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    RuntimeError
+        If GDAL fails to convert the file.
+    """
+    ds = gdal.Translate(out_file, src_file, format='COG',
+                        creationOptions=['COMPRESS=DEFLATE', 'PREDICTOR=3', 'BLOCKSIZE=512', 'OVERVIEWS=AUTO',
+                                         'RESAMPLING=AVERAGE', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER'])
+    if ds is None:
+        raise RuntimeError('Could not convert {0} to COG: {1}'.format(src_file, gdal.GetLastErrorMsg()))
+    # Close the dataset to flush it to disk
+    ds = None
@@ -1,7 +1,7 @@
 """
 This module provides functions for generating and analyzing hexagonal grids based on a specified area of interest (AOI) and raster data.
 
-This module requires the following libraries to be installed: `rasterio`, `geopandas`, `h3`, `shapely`, `rasterstats`, `pandas`, and `fiona`.
+This module requires the following libraries to be installed: `rasterio`, `geopandas`, `h3`, `shapely`, `numpy`, `pandas`, and `fiona` or `pyogrio`.
 
 Functions
 ---------
@@ -12,15 +12,36 @@ create_hexagons_with_statistics(folder_name, aoi_geojson, hexagons_size):
 
 
 import rasterio
+from rasterio.features import rasterize
 import geopandas as gpd
 from geopandas import GeoSeries
 import matplotlib.pyplot as plt
 import h3
-from shapely.geometry import Polygon
-from rasterstats import zonal_stats
+import shapely
+import numpy as np
 import pandas as pd
-import fiona
 import os
+import hashlib
+import functools
+import importlib.util
+import json
+from collections import defaultdict
+
+# h3 v4 renamed the functions used here, both v3 (pinned in hexagons.yml) and v4 are supported
+_H3_V4 = hasattr(h3, "geo_to_cells")
+
+# pyogrio is optional: when it is installed the GeoJSON files are read and written through it instead of fiona
+_IO_ENGINE = "pyogrio" if importlib.util.find_spec("pyogrio") is not None else "fiona"
+
+# exactextract is optional: when it is installed the hexagon means are weighted by the covered fraction of each pixel
+try:
+    from exactextract import exact_extract
+except ImportError:
+    exact_extract = None
+
+
+# Folder where the zonal statistics of each COG composite are cached
+STATISTICS_CACHE_DIRECTORY = ".hexagons_cache"
 
 
 def create_hexagons_with_statistics(folder_name, aoi_geojson, hexagons_size):
@@ -29,7 +50,10 @@ def create_hexagons_with_statistics(folder_name, aoi_geojson, hexagons_size):
 
     This function generates aggregation hexagons within the AOI using the H3 library and calculates
     the mean LST value in °C for each hexagon based on the COG summer composites. The hexagons geometry 
-    and their corresponding mean LST values are exported as a GeoJSON file.
+    and their corresponding mean LST values are exported as a GeoJSON file. The statistics of each
+    COG composite are cached in `STATISTICS_CACHE_DIRECTORY` and only recomputed when the composite,
+    the AOI or the hexagons size change. If the GeoJSON file was created with the same parameters
+    and is newer than the AOI and all the COG composites, nothing is recomputed.
 
     Parameters
     ----------
@@ -53,32 +77,44 @@ def create_hexagons_with_statistics(folder_name, aoi_geojson, hexagons_size):
     ----------
     H3 Documentation: https://h3geo.org/
     """
-    #Open and display the area of interest file
-    aoi = gpd.read_file(aoi_geojson)
+    output_file = 'Hexagons_Summer.geojson'
+    cog_files = sorted(os.path.join(folder_name, cog_file) for cog_file in os.listdir(folder_name) if cog_file.endswith("_cog.tif"))
+
+    # Skip the computation if the GeoJSON was created with the same parameters after the last change of its inputs
+    parameters = {"aoi_geojson": aoi_geojson, "hexagons_size": hexagons_size, "cog_files": cog_files,
+                  "exactextract": exact_extract is not None}
+    if _is_up_to_date(output_file, parameters, [aoi_geojson] + cog_files):
+        print('Hexagons geojson with statistics is up to date')
+        return
+
+    # Open the area of interest file, parsed only once as long as it is unchanged
+    aoi_geometry = _load_aoi_geometry(aoi_geojson, os.path.getmtime(aoi_geojson))
 
     # Generate hexagons within the AOI using H3 library
-    hexagons = h3.polyfill(aoi.geometry[0].__geo_interface__, hexagons_size, geo_json_conformant=True)
+    hexagons = _polyfill(aoi_geometry, hexagons_size)
+
+    # Convert the H3 hexagon boundaries to Shapely Polygon objects at once. The boundaries are
+    # concatenated with the index of their hexagon, since pentagons have fewer vertices
+    boundaries = [_cell_boundary(hex_id) for hex_id in hexagons]
+    coords = np.concatenate(boundaries).astype(np.float64)
+    indices = np.repeat(np.arange(len(boundaries)), [len(boundary) for boundary in boundaries])
+    polygons = shapely.polygons(shapely.linearrings(coords, indices=indices))
 
-    # Define a lambda function to convert H3 hexagon IDs to Shapely Polygon objects
-    polygonise = lambda hex_id: Polygon(h3.h3_to_geo_boundary(hex_id, geo_json=True))
+    # Create a GeoSeries of polygons from the hexagons, with the 64-bit integer hexagon IDs as index
+    hexagon_ids = pd.Index(np.fromiter(map(_cell_to_int, hexagons), dtype=np.uint64, count=len(hexagons)), name="h3")
+    hexagons_geoseries = gpd.GeoSeries(polygons, index=hexagon_ids, crs="EPSG:4326")
 
-    # Create a GeoSeries of polygons from the hexagons, with hexagon IDs as index
-    hexagons_geoseries = gpd.GeoSeries(list(map(polygonise, hexagons)), index=hexagons, crs="EPSG:4326")
+    # Hash of the AOI file, identifying the hexagons in the statistics cache
+    with open(aoi_geojson, 'rb') as f:
+        aoi_hash = hashlib.sha1(f.read()).hexdigest()
 
     # Create an empty DataFrame to store the statistics
     statistics_df = pd.DataFrame(index=hexagons_geoseries.index)
 
-    for cog_file in os.listdir(folder_name):
-        if cog_file.endswith("_cog.tif"):
-
-            # Get the year from the cog file name
-            year= cog_file[-17:-15]
-        
-            # Calculate zonal statistics for the raster within each polygon in hexagons_geoseries
-            statistics = zonal_stats(hexagons_geoseries, os.path.join(folder_name, cog_file), stats="mean")
-            
-            # Extract the mean values from the statistics and add them as a new column in the DataFrame
-            statistics_df[f's_mean_{year}'] = [stat['mean'] if stat is not None else None for stat in statistics]
+    # Calculate (or load from the cache) the mean of every COG composite within each hexagon
+    # and add them as new columns in the DataFrame
+    for column, means in _zonal_means(hexagons_geoseries, cog_files, hexagons_size, aoi_hash).items():
+        statistics_df[column] = means
 
     # Concatenate hexagons_geoseries and statistics_df along the columns axis
     hexagons_statistics = pd.concat([hexagons_geoseries, statistics_df], axis=1)
@@ -99,6 +135,251 @@ def create_hexagons_with_statistics(folder_name, aoi_geojson, hexagons_size):
     hexagons_statistics_gdf = hexagons_statistics_gdf.drop(0, axis=1)  
 
     # Export as GeoJSON
-    hexagons_statistics_gdf.to_file('Hexagons_Summer.geojson', driver='GeoJSON')
+    hexagons_statistics_gdf.to_file(output_file, driver='GeoJSON', engine=_IO_ENGINE)
+
+    # Record the parameters of the GeoJSON in a sidecar file, used to skip unchanged reruns
+    with open(output_file + ".json", "w") as f:
+        json.dump(parameters, f)
+
+    print('Hexagons geojson with statistics successfully created')
+
+
+def _is_up_to_date(output_file, parameters, input_files):
+    """Check whether an output file was created with the given parameters after its inputs last changed.
+
+    Parameters
+    ----------
+    output_file : str
+        The path of the output file, whose parameters are stored in a '.json' sidecar file.
+    parameters : dict
+        The parameters the output file should have been created with.
+    input_files : list of str
+        The paths of the input files.
+
+    Returns
+    -------
+    bool
+        True if the output file does not need to be created again.
+    """
+    if not os.path.exists(output_file) or not os.path.exists(output_file + ".json"):
+        return False
+    with open(output_file + ".json") as f:
+        if json.load(f) != parameters:
+            return False
+    return os.path.getmtime(output_file) > max(os.path.getmtime(input_file) for input_file in input_files)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_aoi_geometry(aoi_geojson, mtime):
+    """Read the geometry of the first feature of an AOI file as a GeoJSON-like dict.
+
+    The result is cached by file path and modification time, so the file is only
+    parsed again when it changes.
+
+    Parameters
+    ----------
+    aoi_geojson : str
+        The file path of the AOI in GeoJSON format.
+    mtime : float
+        The modification time of the file, part of the cache key.
+
+    Returns
+    -------
+    dict
+        The GeoJSON-like geometry of the AOI.
+    """
+    return gpd.read_file(aoi_geojson, engine=_IO_ENGINE).geometry[0].__geo_interface__
+
+
+def _polyfill(geometry, resolution):
+    """Get the IDs of the H3 cells whose center is inside a GeoJSON geometry.
+
+    Parameters
+    ----------
+    geometry : dict
+        The GeoJSON-like geometry, with (longitude, latitude) coordinates.
+    resolution : int
+        The H3 resolution.
+
+    Returns
+    -------
+    list of str
+        The H3 cell IDs.
+    """
+    if _H3_V4:
+        return list(h3.geo_to_cells(geometry, resolution))
+    return list(h3.polyfill(geometry, resolution, geo_json_conformant=True))
+
+
+def _cell_boundary(hex_id):
+    """Get the (longitude, latitude) vertices of the boundary of an H3 cell."""
+    if _H3_V4:
+        return [(lng, lat) for lat, lng in h3.cell_to_boundary(hex_id)]
+    return h3.h3_to_geo_boundary(hex_id, geo_json=True)
+
+
+def _cell_to_int(hex_id):
+    """Convert an H3 cell ID from its hexadecimal string to its 64-bit integer form."""
+    if _H3_V4:
+        return h3.str_to_int(hex_id)
+    return h3.string_to_h3(hex_id)
+
+
+def _zonal_means(hexagons_geoseries, cog_files, hexagons_size, aoi_hash):
+    """Calculate the mean of each COG composite band within each hexagon, reusing the cached results if available.
 
-    print('Hexagons geojson with statistics successfully created')
\ No newline at end of file
+    The results of each COG composite are cached under a key built from the path, modification
+    time and size of the file, the hexagons size and the hash of the AOI file. When exactextract
+    is installed the means are weighted by the fraction of each pixel covered by the hexagons.
+    Otherwise the composites without cached results are grouped by grid (CRS, transform and size),
+    and the hexagons are rasterized only once per grid instead of once per composite.
+
+    Each band gives a column named after the year of its composite, taken from the band
+    description for multi-band COGs (see `ECOSTRESS.format_median_composite_cog`) and from
+    the file name otherwise.
+
+    Parameters
+    ----------
+    hexagons_geoseries : geopandas.GeoSeries
+        The hexagons, with hexagon IDs as index.
+    cog_files : list of str
+        The file paths of the COG composites.
+    hexagons_size : int
+        The size (resolution) of the hexagons.
+    aoi_hash : str
+        The SHA-1 hash of the AOI file.
+
+    Returns
+    -------
+    dict of str to pandas.Series
+        The mean values within each hexagon, indexed by hexagon ID, by column name.
+    """
+    statistics = {}
+    groups = defaultdict(list)
+    for cog_file in cog_files:
+        cache_path = _cache_path(cog_file, hexagons_size, aoi_hash)
+        cached = pd.read_pickle(cache_path) if os.path.exists(cache_path) else None
+        # Reuse the cached statistics only if they are indexed by the same type of hexagon IDs
+        if cached is not None and cached.index.dtype == hexagons_geoseries.index.dtype:
+            statistics.update(cached.items())
+        else:
+            with rasterio.open(cog_file) as src:
+                groups[(src.crs, tuple(src.transform), src.width, src.height)].append(cog_file)
+
+    for group in groups.values():
+        if exact_extract is not None:
+            means = np.concatenate([_exact_zonal_means(hexagons_geoseries, cog_file) for cog_file in group])
+        else:
+            means = _stacked_zonal_means(hexagons_geoseries, group)
+
+        # Name the columns after the year of each composite, e.g. 'Median_S_Summer_22_Masked'
+        group_statistics = defaultdict(dict)
+        band_means = iter(means)
+        for cog_file in group:
+            with rasterio.open(cog_file) as src:
+                stem = os.path.basename(cog_file)[:-len("_cog.tif")]
+                for description in src.descriptions:
+                    name = description if src.count > 1 and description else stem
+                    group_statistics[cog_file][f's_mean_{name[-9:-7]}'] = pd.Series(next(band_means), index=hexagons_geoseries.index)
+
+        os.makedirs(STATISTICS_CACHE_DIRECTORY, exist_ok=True)
+        for cog_file, file_statistics in group_statistics.items():
+            pd.DataFrame(file_statistics).to_pickle(_cache_path(cog_file, hexagons_size, aoi_hash))
+            statistics.update(file_statistics)
+
+    return statistics
+
+
+def _exact_zonal_means(hexagons_geoseries, cog_file):
+    """Calculate the mean of each band of a raster within each hexagon with exactextract.
+
+    The pixels are weighted by the fraction of their area covered by the hexagon, and
+    NaN values are ignored.
+
+    Parameters
+    ----------
+    hexagons_geoseries : geopandas.GeoSeries
+        The hexagons.
+    cog_file : str
+        The file path of the COG composite.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (band, hexagon) mean values, NaN for the hexagons without valid pixels.
+    """
+    hexagons_gdf = gpd.GeoDataFrame(geometry=hexagons_geoseries.reset_index(drop=True))
+    statistics = exact_extract(cog_file, hexagons_gdf, "mean", output="pandas")
+    return statistics.to_numpy(dtype=np.float64).T
+
+
+def _stacked_zonal_means(hexagons_geoseries, cog_files):
+    """Calculate the mean of each band of rasters sharing the same grid within each hexagon.
+
+    As in `rasterstats.zonal_stats`, the pixels whose center is inside a hexagon are
+    taken into account and NaN values are ignored. All the hexagons are rasterized at once
+    into a label raster, from which the means of every band are computed with `np.bincount`.
+
+    Parameters
+    ----------
+    hexagons_geoseries : geopandas.GeoSeries
+        The hexagons.
+    cog_files : list of str
+        The file paths of the COG composites, all on the same grid.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (band, hexagon) mean values, NaN for the hexagons without valid pixels.
+    """
+    bands = []
+    for cog_file in cog_files:
+        with rasterio.open(cog_file) as src:
+            data = src.read().astype(np.float64)
+            if src.nodata is not None and not np.isnan(src.nodata):
+                data[data == src.nodata] = np.nan
+            transform = src.transform
+            bands.append(data)
+    data = np.concatenate(bands)
+
+    means = np.full((data.shape[0], len(hexagons_geoseries)), np.nan)
+    if len(hexagons_geoseries) == 0:
+        return means
+
+    # Burn the position (from 1) of each hexagon into a label raster in a single pass, with 0 outside the hexagons
+    labels = rasterize(zip(hexagons_geoseries, range(1, len(hexagons_geoseries) + 1)), out_shape=data.shape[1:],
+                       transform=transform, fill=0, dtype="int32")
+
+    # Sum and count the valid values of each label with bincount
+    for band, band_means in zip(data, means):
+        valid = ~np.isnan(band)
+        band_labels = labels[valid]
+        total = np.bincount(band_labels, weights=band[valid], minlength=len(hexagons_geoseries) + 1)[1:]
+        count = np.bincount(band_labels, minlength=len(hexagons_geoseries) + 1)[1:]
+        np.divide(total, count, out=band_means, where=count > 0)
+
+    return means
+
+
+def _cache_path(cog_file, hexagons_size, aoi_hash):
+    """Get the path of the cached zonal statistics of a COG composite.
+
+    Parameters
+    ----------
+    cog_file : str
+        The file path of the COG composite.
+    hexagons_size : int
+        The size (resolution) of the hexagons.
+    aoi_hash : str
+        The SHA-1 hash of the AOI file.
+
+    Returns
+    -------
+    str
+        The path of the cache file.
+    """
+    # The means calculated with and without exactextract differ, so they are cached separately
+    key = hashlib.sha1(
+        f"{cog_file}|{os.path.getmtime(cog_file)}|{os.path.getsize(cog_file)}|{hexagons_size}|{aoi_hash}|{exact_extract is not None}".encode()
+    ).hexdigest()
+    return os.path.join(STATISTICS_CACHE_DIRECTORY, f"{key}.pkl")